@@ -1,11 +1,14 @@
+from functools import lru_cache
 import numpy as np
 from numba import njit
 import networkx as nx
 import tensorflow as tf
 import torch
-from skimage.filters import laplace, gaussian
+from scipy.ndimage import convolve
+from skimage.filters import gaussian
 from skimage.filters import threshold_mean, threshold_triangle, threshold_li
 from skimage.morphology import skeletonize
+from skimage.restoration.uft import laplacian
 # from skimage.morphology import thin, medial_axis
 import matplotlib.pyplot as plt
 
@@ -21,7 +24,7 @@ def neighbors(shape):
     acc = np.cumprod((1,)+shape[::-1][:-1])
     return np.dot(idx, acc[::-1])
 
-@njit # my mark
+@njit(cache=True) # my mark
 def mark(img, nbs): # mark the array use (0, 1, 2)
     img = img.ravel()
     for p in range(len(img)):
@@ -32,7 +35,7 @@ def mark(img, nbs): # mark the array use (0, 1, 2)
         if s==2:img[p]=1
         else:img[p]=2
 
-@njit # trans index to r, c...
+@njit(cache=True) # trans index to r, c...
 def idx2rc(idx, acc):
     rst = np.zeros((len(idx), len(acc)), dtype=np.int16)
     for i in range(len(idx)):
@@ -42,7 +45,7 @@ def idx2rc(idx, acc):
     rst -= 1
     return rst
     
-@njit # fill a node (two or more points)
+@njit(cache=True) # fill a node (two or more points)
 def fill(img, p, num, nbs, acc, buf):
     img[p] = num
     buf[0] = p
@@ -61,7 +64,7 @@ def fill(img, p, num, nbs, acc, buf):
         if cur==s:break
     return iso, idx2rc(buf[:s], acc)
 
-@njit # trace the edge and use a buffer, then buf.copy, if using [] numba doesn't work
+@njit(cache=True) # trace the edge and use a buffer, then buf.copy, if using [] numba doesn't work
 def trace(img, p, nbs, acc, buf):
     c1 = 0; c2 = 0;
     newp = 0
@@ -85,7 +88,7 @@ def trace(img, p, nbs, acc, buf):
         if c2!=0:break
     return (c1-10, c2-10, idx2rc(buf[:cur+1], acc))
    
-@njit # parse the image then get the nodes and edges
+@njit(cache=True) # parse the image then get the nodes and edges
 def parse_struc(img, nbs, acc, iso, ring):
     img = img.ravel()
     buf = np.zeros(131072, dtype=np.int64) # 2**17 = 131072
@@ -296,6 +299,38 @@ def poly_roots_torch_batch(c):
     eigvals = torch.linalg.eigvals(mat)
     return eigvals
 
+def poly_roots_np_batch(c):
+    """
+    Calculate the roots of a monomial with coefficients `c`.
+    The roots are the eigenvalues of the Frobenius companion matrix.
+
+    Parameters
+    ----------
+    c : ndarray, dtype=np.complex64
+        2-D array of polynomial coefficients ordered from low to high degree.
+        The first axis is the batch axis.
+
+    Returns
+    -------
+    roots : ndarray, dtype=np.complex64
+        2-D array of roots of the polynomial.
+    """
+    n = c.shape[1]; batch_size = c.shape[0]
+    if n < 2:
+        return np.array([], dtype=c.dtype)
+    if n == 2:
+        return -c[:, 0] / c[:, 1]
+
+    # Construct the Frobenius companion matrix, already flipped to reduce error
+    mat = np.zeros((batch_size, n - 1, n - 1), dtype=c.dtype)
+    idx = np.arange(n - 2)
+    mat[:, idx, idx + 1] = 1
+    mat[:, :, 0] = -c[:, -2::-1] / c[:, -1, None]
+
+    # Calculate the eigenvalues of all companion matrices in one LAPACK sweep
+    eigvals = np.linalg.eigvals(mat)
+    return eigvals
+
 def _normalize_image(image):
     """
     Normalize an image to the range [0, 1].
@@ -314,6 +349,16 @@ def _normalize_image(image):
     image /= np.max(image)
     return image
 
+@lru_cache(maxsize=8)
+def _laplace_kernel(ndim, ksize):
+    """
+    Discrete Laplacian stencil used by `skimage.filters.laplace`, cached
+    so repeated PosLoG calls skip rebuilding it (and its transfer function).
+    """
+    _, kernel = laplacian(ndim, (ksize,) * ndim)
+    kernel.setflags(write=False)
+    return kernel
+
 def PosLoG(image, sigmas=[0,1], ksizes=[3],
            black_ridges=True, power_scaling=None):
     """
@@ -361,21 +406,26 @@ def PosLoG(image, sigmas=[0,1], ksizes=[3],
     if power_scaling is not None:
         image = image**power_scaling
     
-    filtered_max = np.zeros_like(image)
+    filtered_max = None
     for sigma in sigmas:
+        # the blur does not depend on ksize, so do it once per sigma
+        gauss = gaussian(image, sigma=sigma)
+        if filtered_max is None:
+            # accumulate in C order and in the dtype the blur promotes to
+            filtered_max = np.zeros(gauss.shape, dtype=np.result_type(image, gauss))
         for ksize in ksizes:
-            gauss = gaussian(image, sigma=sigma)
-            lap = laplace(gauss, ksize=ksize)
+            lap = convolve(gauss, _laplace_kernel(gauss.ndim, ksize))
             # remove negative curvature
-            pos = np.maximum(lap, 0)
+            pos = np.maximum(lap, 0, out=lap)
             # normalize to max = 1 unless all zeros
             max_val = pos.max()
             if max_val > 0: pos /= max_val
-            filtered_max = np.maximum(filtered_max, pos)
-            
+            np.maximum(filtered_max, pos, out=filtered_max)
+
+    if filtered_max is None: filtered_max = np.zeros_like(image)
     return filtered_max
 
-def Phi_image(c, Emax=2, Elen=400, method=None):
+def Phi_image(c, Emax=2, Elen=400, method=None, chunk_size=16384):
     '''
     Generate the spectral potential landscape Phi(E) for a given polynomial.
     1-band only.
@@ -396,16 +446,22 @@ def Phi_image(c, Emax=2, Elen=400, method=None):
                             to the least 2 |z|'s
         - 3 or 'log_diff' : log difference of the least 2 |z|'s
         Default is None.
+    chunk_size : int, optional
+        Number of polynomials whose roots are solved per batch. Bounds
+        the memory taken by the stacked companion matrices for large
+        `Elen` or high-degree `c`. Default is 16384.
 
     Returns
     -------
     phi : ndarray
         The 2d image of the spectral potential landscape Phi(E).
     '''
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be a positive integer, got {chunk_size}.')
 
-    E_range = np.linspace(-Emax, Emax, Elen)
-    E_pairs = np.meshgrid(E_range, E_range)
-    E_complex = E_pairs[0] + 1j*E_pairs[1]
+    # stay in complex64 end to end, the roots are solved in single precision
+    E_range = np.linspace(-Emax, Emax, Elen, dtype=np.float32)
+    E_complex = (E_range[None, :] + 1j*E_range[:, None]).astype(np.complex64, copy=False)
 
     p0 = (len(c)-1)//2
     cl = np.trim_zeros(c, 'f')
@@ -414,39 +470,48 @@ def Phi_image(c, Emax=2, Elen=400, method=None):
     c = np.trim_zeros(c)
     poly_len = len(c)
     q = poly_len - E_pos - 1 # p = E_pos
-    coeff = np.zeros((E_complex.size, poly_len), dtype=np.complex64)
-    for i in range(poly_len):
-        coeff[:, i] = c[i]
-    coeff[:, E_pos] -= E_complex.ravel()
-    z = poly_roots_tf_batch(tf.constant(coeff, dtype=tf.complex64)).numpy()
+    # broadcast c over every row, E only shifts the z^0 column
+    coeff = np.empty((E_complex.size, poly_len), dtype=np.complex64)
+    coeff[:] = c
+    coeff[:, E_pos] = c[E_pos] - E_complex.ravel()
+    z = np.empty((coeff.shape[0], poly_len - 1), dtype=np.complex64)
+    for i in range(0, coeff.shape[0], chunk_size):
+        z[i:i+chunk_size] = poly_roots_np_batch(coeff[i:i+chunk_size])
     
+    # only the q largest or the 2 smallest |z|'s are needed, so partition
+    # instead of fully sorting every row
+    absz = np.abs(z)
     if method is None or method == 1 or method == 'spectral':
         # Method 1: spectral potential landscape
-        betas = np.sort(np.abs(z), axis=1)[:, -q:]
+        betas = np.partition(absz, -q, axis=1)[:, -q:]
         phi = np.log(np.abs(c[-1])) + np.sum(np.log(betas), axis=1)
     elif method == 2 or method == 'diff_log':
         # Method 2: kappa derived from least 2 |z|'s
-        kappas = -np.log(np.sort(np.abs(z), axis=1))
+        kappas = -np.log(np.partition(absz, 1, axis=1)[:, :2])
         phi = kappas[:, 0] - kappas[:, 1]
     elif method == 3 or method == 'log_diff':
         # Method 3: log difference of least 2 |z|'s
-        betas = np.sort(np.abs(z), axis=1)
+        betas = np.partition(absz, 1, axis=1)
         phi = np.log(betas[:, 1]-betas[:, 0])
     return phi.reshape(E_complex.shape)
 
-def binarized_Phi_image(c, Emax=2, Elen=400, thresholder=threshold_mean):
-    phi = Phi_image(c, Emax, Elen)
+def binarized_Phi_image(c, Emax=2, Elen=400, thresholder=threshold_mean,
+                        chunk_size=16384):
+    phi = Phi_image(c, Emax, Elen, chunk_size=chunk_size)
     ridge = PosLoG(phi)
     binary = ridge > thresholder(ridge)
     return binary
 
-def Phi_graph(c, Emax=4, Elen=400):
-    ske = skeletonize(binarized_Phi_image(c, Emax, Elen), method='lee')
+def Phi_graph(c, Emax=4, Elen=400, chunk_size=16384):
+    ske = skeletonize(binarized_Phi_image(c, Emax, Elen, chunk_size=chunk_size),
+                      method='lee')
     return skeleton2graph(ske)
 
-def draw_image(image, ax=None, overlay_graph=False, **ax_set_kwargs):
+def draw_image(image, ax=None, overlay_graph=False, skeleton=None,
+               **ax_set_kwargs):
     def to_graph(img, **kwargs):
-        ske = skeletonize(img, method='lee')
+        # reuse the caller's skeleton instead of thinning the image again
+        ske = skeletonize(img, method='lee') if skeleton is None else skeleton
         return skeleton2graph(ske, **kwargs)
 
     if ax is None: ax = plt.gca()